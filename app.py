@@ -1,42 +1,255 @@
 import os
+import sys
 import re
-import json
+import io
+import orjson
+import math
+import time
+import uuid
+import hashlib
+import itertools
+import threading
+import atexit
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from flask.json.provider import JSONProvider
 from werkzeug.utils import secure_filename
 import pdfplumber
+import fitz
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 import imaplib
 import email
 from email.header import decode_header
 
+def _json_default(obj):
+    """Tipi non JSON: gli insiemi (es. po_scaricati) diventano liste, il resto stringhe"""
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+class OrjsonProvider(JSONProvider):
+    """Serializzazione JSON di jsonify/request.json con orjson"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Bytes direttamente nella risposta, senza passare da str
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(body, mimetype='application/json')
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
 app.config['OUTPUT_FOLDER'] = os.environ.get('OUTPUT_FOLDER', 'outputs')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Dietro Apache/lighttpd (o nginx configurato per X-Sendfile) i download li serve il proxy
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
 
+# Pattern precompilati per il parsing dei PDF
+# Preventivo
+_RE_PRATICA_FORNITORE = re.compile(r'Pratica Fornitore:\s*(\d+)')
+_RE_PRATICA_HERTZ = re.compile(r'Pratica Hertz:\s*(\d+)')
+_RE_TARGA = re.compile(r'Targa:\s*([A-Z0-9]+)')
+_RE_TELAIO = re.compile(r'Telaio:\s*([A-Z0-9]+)')
+_RE_KM = re.compile(r'Km:\s*(\d+)')
+_RE_VEICOLO = re.compile(r'Veicolo \(Marca - Modello - Versione\):\s*([^\n]+)')
+_RE_SMALTIMENTO = re.compile(r'Smaltimento Rifiuti[^\d]*(€?[\d.,]+)')
+_RE_MANODOPERA_ORE = re.compile(r'ore\s+([\d.,]+)\s*x\s*([\d.,]+)')
+# Purchase order
+_RE_PO_NUMBER = re.compile(r'PURCHASE ORDER #.*?(\d+)', re.DOTALL)
+_RE_WD = re.compile(r'WD:\s*(\d+)')
+_RE_PLATE = re.compile(r'Plate Number:\s*([A-Z0-9]+)')
+_RE_VIN = re.compile(r'Serial Number \(VIN\):\s*([A-Z0-9]+)')
+_RE_UNIT = re.compile(r'Unit Number:\s*(\d+)')
+_RE_MODEL = re.compile(r'Model:\s*([^\n]+)')
+_RE_MILEAGE = re.compile(r'Mileage:\s*(\d+)')
+_RE_TOTAL = re.compile(r'TOTAL\s+€\s*([\d.]+)')
+_RE_PO_DATE = re.compile(r'Date:\s*(\d{1,2})([/-])(\d{1,2})([/-])(\d{4})')
+_RE_DATE = re.compile(r'(\d{1,2})([/-])(\d{1,2})([/-])(\d{4})')
+# Risposte IMAP
+_RE_IMAP_UID = re.compile(rb'UID (\d+)')
+
+# ID univoci dei documenti caricati (anche per più PDF nello stesso istante)
+_id_counter = itertools.count(int(time.time() * 1000))
+
+# Righe di intestazione e voci di riepilogo da saltare nelle tabelle dei preventivi
+_TABLE_HEADER_TOKENS = ('C.R.', 'Voci di Danno', 'IMPONIBILE', 'Totale tempi')
+_TABLE_SKIP_KEYWORDS = ('Ricambi', 'Materiale', 'Smaltimento', 'Manodopera', 'TOTALI', 'Note:')
+_MANODOPERA_TIPI = ('meccanica', 'carrozzeria', 'verniciatura')
+
+# Attesa prima di salvare le modifiche ravvicinate (secondi)
+SAVE_DELAY = 0.5
+# Buffer per la copia su disco dei PDF caricati
+UPLOAD_BUFFER_SIZE = 1 << 20
+# Connessione IMAP inutilizzata da più di così viene chiusa (secondi)
+IMAP_IDLE_TIMEOUT = 600
+
+
+def _date_from_match(match):
+    """Data YYYY-MM-DD da un match di _RE_PO_DATE/_RE_DATE: prima GG/MM/AAAA, poi MM/GG/AAAA"""
+    first, sep1, second, sep2, year = match.groups()
+    if sep1 != sep2: return None
+    first, second, year = int(first), int(second), int(year)
+    for day, month in ((first, second), (second, first)):
+        try:
+            return datetime(year, month, day).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def _fitz_open(pdf_source):
+    """Apre con PyMuPDF un percorso o il contenuto PDF già in memoria (bytes)"""
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return fitz.open(stream=pdf_source, filetype='pdf')
+    return fitz.open(pdf_source)
+
+
+def _pdfplumber_open(pdf_source):
+    """Apre con pdfplumber un percorso o il contenuto PDF già in memoria (bytes)"""
+    if isinstance(pdf_source, (bytes, bytearray)):
+        return pdfplumber.open(io.BytesIO(pdf_source))
+    return pdfplumber.open(pdf_source)
+
+
+def _safe_unlink(path):
+    """Elimina un file ignorando il caso in cui non esista già più"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _parse_num(s):
+    if not s: return 0
+    try: num = float(str(s).replace(',', '.').replace('€', '').strip())
+    except ValueError: return 0
+    return num if math.isfinite(num) else 0
+
+
+def _render_xml(prev, po, invoice_number, numbering_suffix):
+    """XML Easyfatt di una fattura: restituisce (bytes, totale) senza toccare lo stato"""
+    root = ET.Element('EasyfattDocuments')
+    
+    company = ET.SubElement(root, 'Company')
+    ET.SubElement(company, 'Name').text = 'SCHIAVI GOMME SRL'
+    ET.SubElement(company, 'Address').text = 'VIA UTA 20'
+    ET.SubElement(company, 'Postcode').text = '00133'
+    ET.SubElement(company, 'City').text = 'ROMA'
+    ET.SubElement(company, 'Province').text = 'RM'
+    ET.SubElement(company, 'FiscalCode').text = '13021431005'
+    ET.SubElement(company, 'VatCode').text = '13021431005'
+    ET.SubElement(company, 'Tel').text = '0622152148'
+    ET.SubElement(company, 'Email').text = 'schiavigomme@gmail.com'
+    
+    documents = ET.SubElement(root, 'Documents')
+    document = ET.SubElement(documents, 'Document')
+    
+    ET.SubElement(document, 'CustomerCode').text = '999999'
+    ET.SubElement(document, 'CustomerName').text = 'HERTZ ITALIANA S.R.L.'
+    ET.SubElement(document, 'CustomerAddress').text = 'VIA DEL CASALE CAVALLARI, 204'
+    ET.SubElement(document, 'CustomerPostcode').text = '00156'
+    ET.SubElement(document, 'CustomerCity').text = 'ROMA'
+    ET.SubElement(document, 'CustomerProvince').text = 'RM'
+    ET.SubElement(document, 'CustomerCountry').text = 'IT'
+    ET.SubElement(document, 'CustomerFiscalCode').text = '00433120581'
+    ET.SubElement(document, 'CustomerVatCode').text = 'IT00890931009'
+    
+    ET.SubElement(document, 'DocumentType').text = 'I'
+    ET.SubElement(document, 'Date').text = datetime.now().strftime('%Y-%m-%d')
+    
+    ET.SubElement(document, 'Number').text = str(invoice_number)
+    ET.SubElement(document, 'Numbering').text = f"/{numbering_suffix}"
+    
+    total_without_tax = sum(item['total'] for item in prev['items'])
+    vat_amount = total_without_tax * 0.22
+    total = total_without_tax + vat_amount
+    
+    ET.SubElement(document, 'TotalWithoutTax').text = f"{total_without_tax:.2f}"
+    ET.SubElement(document, 'VatAmount').text = f"{vat_amount:.2f}"
+    ET.SubElement(document, 'Total').text = f"{total:.2f}"
+    ET.SubElement(document, 'PricesIncludeVat').text = 'false'
+    ET.SubElement(document, 'PaymentName').text = 'Bonifico 60 gg'
+    
+    # Aggiungo Commento con PO e Targa
+    targa = prev.get('targa') or po.get('targa') or ''
+    ET.SubElement(document, 'InternalComment').text = f"PO: {po['po_number']} - Targa: {targa}"
+    
+    rows = ET.SubElement(document, 'Rows')
+    
+    row_vehicle = ET.SubElement(rows, 'Row')
+    vehicle_desc = f"""PO Number: {po['po_number']}
+Plate Number: {po['targa']}
+Serial Number (VIN): {po['vin']}
+Unit Number: {po['unit_number']}
+Model: {po['model']}
+Country: IT
+Type: L
+Mileage: {po['mileage']}
+Car/Van: V
+Pratica Hertz: {prev['pratica_hertz']}"""
+    ET.SubElement(row_vehicle, 'Description').text = vehicle_desc
+    
+    for item in prev['items']:
+        row = ET.SubElement(rows, 'Row')
+        if item.get('codice_ricambio'):
+            ET.SubElement(row, 'Code').text = item['codice_ricambio']
+        ET.SubElement(row, 'Description').text = item['description']
+        ET.SubElement(row, 'Qty').text = str(item['qty'])
+        ET.SubElement(row, 'Price').text = f"{item['price']:.2f}"
+        if item['discount'] > 0:
+            ET.SubElement(row, 'Discounts').text = f"{item['discount']:.2f}%"
+        ET.SubElement(row, 'VatCode', Perc="22.0", Class="Imponibile")
+        ET.SubElement(row, 'Total').text = f"{item['total']:.2f}"
+    
+    ET.indent(root, space="  ")
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True), total
+
 
 class HertzProcessor:
     def __init__(self):
         self.data_file = Path("hertz_data.json")
         self.initial_data_file = Path("hertz_data_initial.json")
+        self.fatture_file = Path("fatture_generate.jsonl")
+        self._dirty = False
+        self._stats_version = 0
+        self._stats_cache = None
+        self._boot_id = uuid.uuid4().hex[:8]
+        self._lock = threading.RLock()
+        # PyMuPDF non supporta l'uso da più thread: un parsing alla volta
+        self._parse_lock = threading.Lock()
+        self._imap = None
+        self._imap_credentials = None
+        self._imap_lock = threading.Lock()
+        self._imap_last_used = 0
+        self._imap_reaper = None
+        self._save_timer = None
         self.load_data()
+        self.rebuild_indexes()
     
     def load_data(self):
         if self.data_file.exists():
-            with open(self.data_file, 'r') as f:
-                self.data = json.load(f)
+            with open(self.data_file, 'rb') as f:
+                self.data = orjson.loads(f.read())
+            self._load_fatture()
         else:
             # Prova a caricare dati iniziali se esistono
             if self.initial_data_file.exists():
                 print("📦 Caricamento dati iniziali da hertz_data_initial.json...")
-                with open(self.initial_data_file, 'r') as f:
-                    self.data = json.load(f)
+                with open(self.initial_data_file, 'rb') as f:
+                    self.data = orjson.loads(f.read())
                 print(f"✅ Caricati: {len(self.data.get('preventivi', []))} preventivi, "
                       f"{len(self.data.get('purchase_orders', []))} PO, "
                       f"{len(self.data.get('fatture_generate', []))} fatture")
@@ -58,13 +271,14 @@ class HertzProcessor:
                         'ultimo_controllo': None
                     }
                 }
-            self.save_data()
+            self._load_fatture()
+            self._dirty = True
         
         # Migrazione da vecchia configurazione
         if 'last_number_hg' not in self.data['config']:
             self.data['config']['last_number_hg'] = 0
             self.data['config']['last_number_hm'] = 0
-            self.save_data()
+            self._dirty = True
         
         if 'email_config' not in self.data:
             self.data['email_config'] = {
@@ -76,40 +290,263 @@ class HertzProcessor:
                 'data_inizio': None,
                 'po_scaricati': []  # Lista dei PO già scaricati
             }
-            self.save_data()
+            self._dirty = True
         
         # Assicura che po_scaricati esista (per upgrade)
         if 'po_scaricati' not in self.data['email_config']:
             self.data['email_config']['po_scaricati'] = []
-            self.save_data()
+            self._dirty = True
+        # In memoria è un insieme (ricerca O(1)); su disco resta una lista
+        self.data['email_config']['po_scaricati'] = set(self.data['email_config']['po_scaricati'])
         if 'data_inizio' not in self.data['email_config']:
             self.data['email_config']['data_inizio'] = None
-            self.save_data()
+            self._dirty = True
+        
+        # Hash del contenuto dei PDF caricati -> documento estratto
+        if 'hash_index' not in self.data:
+            self.data['hash_index'] = {}
+            self._dirty = True
+        
+        self._reconcile_numbering()
+        self._drop_invoiced_documents()
+        
+        # Un'unica scrittura per tutte le migrazioni; nessuna se i dati sono già aggiornati
+        self.flush()
+    
+    def _drop_invoiced_documents(self):
+        """Toglie preventivi e PO già fatturati rimasti nel file principale dopo un'interruzione"""
+        fatture = self.data['fatture_generate']
+        pratiche = {f.get('pratica_hertz') for f in fatture}
+        po_numbers = {f.get('po_number') for f in fatture}
+        preventivi = [p for p in self.data['preventivi'] if p['pratica_hertz'] not in pratiche]
+        purchase_orders = [p for p in self.data['purchase_orders'] if p['po_number'] not in po_numbers]
+        if (len(preventivi) != len(self.data['preventivi'])
+                or len(purchase_orders) != len(self.data['purchase_orders'])):
+            self.data['preventivi'] = preventivi
+            self.data['purchase_orders'] = purchase_orders
+            self._dirty = True
+    
+    def _reconcile_numbering(self):
+        """Porta i contatori HG/HM almeno al numero più alto registrato dopo l'ultimo salvataggio
+
+        Le fatture finiscono subito nel file JSONL, i contatori solo al salvataggio del
+        file principale: dopo un'interruzione a metà i numeri non devono ripetersi.
+        Le fatture già coperte dal salvataggio non contano, così una correzione manuale
+        della numerazione resta valida anche dopo un riavvio.
+        """
+        config = self.data['config']
+        # Numero di fatture presenti all'ultimo salvataggio (assente nei file più vecchi)
+        salvate = self.data.pop('fatture_salvate', None)
+        nuove = self.data['fatture_generate'][salvate or 0:]
+        registrate = []
+        for fattura in nuove:
+            key = {'HG': 'last_number_hg', 'HM': 'last_number_hm'}.get(fattura.get('tipo'))
+            try:
+                year = int(str(fattura.get('data_generazione', ''))[:4])
+                number = int(fattura.get('numero_fattura'))
+            except (TypeError, ValueError):
+                continue
+            if key:
+                registrate.append((year, key, number))
+        
+        last_year = max((year for year, _, _ in registrate), default=config['year'])
+        if last_year > config['year']:
+            config['year'] = last_year
+            config['last_number_hg'] = 0
+            config['last_number_hm'] = 0
+            self._dirty = True
+        for year, key, number in registrate:
+            if year == config['year'] and number > config[key]:
+                config[key] = number
+                self._dirty = True
+    
+    def _load_fatture(self):
+        """Carica le fatture dal file JSONL; se manca lo crea dai dati già presenti"""
+        if self.fatture_file.exists():
+            with open(self.fatture_file, 'rb') as f:
+                lines = [line for line in f if line.strip()]
+            fatture = []
+            for i, line in enumerate(lines):
+                try:
+                    fatture.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    if i != len(lines) - 1:
+                        raise
+                    # Ultima riga scritta a metà (interruzione durante l'append): si scarta
+                    print(f"⚠️ Riga finale non valida in {self.fatture_file}, ignorata")
+            self.data['fatture_generate'] = fatture
+            if len(fatture) != len(lines):
+                # Riscrive il file senza la riga troncata, così i prossimi append restano validi
+                self.save_fatture()
+        else:
+            self.data.setdefault('fatture_generate', [])
+            self.save_fatture()
+            # Il file principale va riscritto senza l'elenco fatture
+            self._dirty = True
     
     def save_data(self):
-        with open(self.data_file, 'w') as f:
-            json.dump(self.data, f, indent=2, default=str)
+        # Scrittura atomica: file temporaneo + os.replace
+        # Le fatture generate stanno nel file JSONL separato
+        tmp_file = self.data_file.with_name(self.data_file.name + '.tmp')
+        with self._lock:
+            data = {k: v for k, v in self.data.items() if k != 'fatture_generate'}
+            # Al riavvio i contatori si confrontano solo con le fatture oltre questo numero:
+            # chi elimina fatture salva anche il file principale per tenerlo allineato
+            data['fatture_salvate'] = len(self.data['fatture_generate'])
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps(data, default=_json_default))
+            os.replace(tmp_file, self.data_file)
+            self._dirty = False
+            self._stats_version += 1
+    
+    def save_fatture(self):
+        """Riscrive per intero il file delle fatture (solo dopo eliminazioni)"""
+        tmp_file = self.fatture_file.with_name(self.fatture_file.name + '.tmp')
+        with self._lock:
+            with open(tmp_file, 'wb') as f:
+                for fattura in self.data['fatture_generate']:
+                    f.write(orjson.dumps(fattura, default=_json_default, option=orjson.OPT_APPEND_NEWLINE))
+            os.replace(tmp_file, self.fatture_file)
+            self._stats_version += 1
+    
+    def append_fattura(self, fattura):
+        """Registra una nuova fattura con un append sul file JSONL"""
+        with self._lock:
+            self.data['fatture_generate'].append(fattura)
+            with open(self.fatture_file, 'ab') as f:
+                f.write(orjson.dumps(fattura, default=_json_default, option=orjson.OPT_APPEND_NEWLINE))
+            self._stats_version += 1
+    
+    def delete_fattura(self, filename):
+        """Toglie dall'elenco le fatture con questo nome file, mantenendo l'ordine"""
+        with self._lock:
+            fatture = [f for f in self.data['fatture_generate'] if f['filename'] != filename]
+            if len(fatture) == len(self.data['fatture_generate']):
+                return False
+            self.data['fatture_generate'] = fatture
+            self.rebuild_indexes()
+            self.save_fatture()
+            self.save_data()
+            return True
+    
+    def flush(self):
+        """Salva su disco solo se ci sono modifiche non ancora scritte"""
+        if self._dirty:
+            self.save_data()
+    
+    def schedule_save(self):
+        """Salva dopo SAVE_DELAY, raggruppando in una scrittura le modifiche ravvicinate"""
+        with self._lock:
+            self._mark_changed()
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(SAVE_DELAY, self._timed_flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+    
+    def _timed_flush(self):
+        with self._lock:
+            self._save_timer = None
+            self.flush()
+    
+    def _mark_changed(self):
+        """Dati modificati in memoria: da salvare e statistiche da ricalcolare"""
+        self._dirty = True
+        self._stats_version += 1
+    
+    def rebuild_indexes(self):
+        """Ricostruisce gli indici in memoria usati per i controlli duplicati"""
+        fatture = self.data['fatture_generate']
+        self._invoiced_pratiche = {f.get('pratica_hertz') for f in fatture}
+        self._invoiced_po = {f.get('po_number') for f in fatture}
+        self._preventivi_pratiche = {p['pratica_hertz'] for p in self.data['preventivi']}
+        self._po_numbers = {p['po_number'] for p in self.data['purchase_orders']}
+        self._prune_hash_index()
+        self._stats_version += 1
+    
+    def _prune_hash_index(self):
+        """Tiene nell'indice hash solo i documenti ancora in attesa (non eliminati né fatturati)"""
+        hash_index = self.data['hash_index']
+        pending = {
+            h: entry for h, entry in hash_index.items()
+            if (entry['pratica_hertz'] in self._preventivi_pratiche if entry['type'] == 'preventivo'
+                else entry['po_number'] in self._po_numbers)
+        }
+        if len(pending) != len(hash_index):
+            self.data['hash_index'] = pending
+            self._dirty = True
     
     def is_po_invoiced(self, po_number):
-        return po_number in [f.get('po_number') for f in self.data['fatture_generate']]
+        return po_number in self._invoiced_po
+    
+    def _get_cached_stats(self):
+        # Ricalcola solo se i dati sono cambiati dall'ultima richiesta
+        version = self._stats_version
+        cached = self._stats_cache
+        if cached is None or cached['version'] != version:
+            stats = self._compute_stats()
+            match_by_pratica = {}
+            for m in stats['matches']:
+                match_by_pratica.setdefault(m['preventivo']['pratica_hertz'], m)
+            cached = {
+                'version': version,
+                'stats': stats,
+                'match_by_pratica': match_by_pratica,
+                'matches_sorted': None,
+                'documents_sorted': None
+            }
+            self._stats_cache = cached
+        return cached
+    
+    def data_etag(self):
+        """ETag dei dati correnti: cambia a ogni modifica e a ogni riavvio"""
+        return f"{self._boot_id}-{self._stats_version}"
     
     def get_stats(self):
+        # Copia: le route aggiungono campi al dizionario restituito
+        return dict(self._get_cached_stats()['stats'])
+    
+    def find_match(self, pratica_hertz):
+        """Match preventivo/PO pronto per la fattura della pratica indicata"""
+        return self._get_cached_stats()['match_by_pratica'].get(pratica_hertz)
+    
+    def get_sorted_matches(self):
+        """Match ordinati per data PO (più vecchi prima)"""
+        cached = self._get_cached_stats()
+        if cached['matches_sorted'] is None:
+            cached['matches_sorted'] = sorted(cached['stats']['matches'],
+                                              key=lambda m: m['po'].get('date') or '9999-99-99')
+        return cached['matches_sorted']
+    
+    def get_sorted_documents(self):
+        """Preventivi e PO per data di caricamento (più recenti prima), ordinati una volta per versione dei dati"""
+        cached = self._get_cached_stats()
+        if cached['documents_sorted'] is None:
+            docs = self.data['preventivi'] + self.data['purchase_orders']
+            docs.sort(key=lambda x: x.get('data_caricamento', ''), reverse=True)
+            cached['documents_sorted'] = docs
+        return cached['documents_sorted']
+    
+    def _compute_stats(self):
         preventivi = self.data['preventivi']
         pos = self.data['purchase_orders']
         
+        invoiced = self._invoiced_po
+        
+        # Indice pratica -> primo PO caricato per quella pratica
+        po_by_pratica = {}
+        for po in pos:
+            po_by_pratica.setdefault(po.get('pratica_hertz'), po)
+        
         matches = []
+        matched_pratiche = set()
         for prev in preventivi:
-            for po in pos:
-                if prev.get('pratica_hertz') == po.get('pratica_hertz'):
-                    if not self.is_po_invoiced(po.get('po_number')):
-                        matches.append({'preventivo': prev, 'po': po})
-                    break
-        
-        matched_pratiche_prev = {m['preventivo']['pratica_hertz'] for m in matches}
-        matched_pratiche_po = {m['po']['pratica_hertz'] for m in matches}
+            po = po_by_pratica.get(prev.get('pratica_hertz'))
+            if po is not None and po.get('po_number') not in invoiced:
+                matches.append({'preventivo': prev, 'po': po})
+                matched_pratiche.add(prev.get('pratica_hertz'))
         
-        prev_in_attesa = [p for p in preventivi if p['pratica_hertz'] not in matched_pratiche_prev]
-        po_in_attesa = [p for p in pos if p['pratica_hertz'] not in matched_pratiche_po and not self.is_po_invoiced(p.get('po_number'))]
+        prev_in_attesa = [p for p in preventivi if p['pratica_hertz'] not in matched_pratiche]
+        po_in_attesa = [p for p in pos if p['pratica_hertz'] not in matched_pratiche and p.get('po_number') not in invoiced]
         
         return {
             'pdf_in_attesa': len(prev_in_attesa) + len(po_in_attesa),
@@ -123,32 +560,35 @@ class HertzProcessor:
             'matches': matches
         }
     
-    def extract_text_from_pdf(self, pdf_path):
-        with pdfplumber.open(pdf_path) as pdf:
-            text = ""
-            for page in pdf.pages:
-                text += page.extract_text() or ""
-            return text
+    def extract_text_from_pdf(self, pdf_source):
+        # PyMuPDF: molto più veloce di pdfplumber quando serve solo il testo
+        with _fitz_open(pdf_source) as pdf:
+            return "".join(page.get_text("text") for page in pdf)
     
-    def extract_tables_from_pdf(self, pdf_path):
-        with pdfplumber.open(pdf_path) as pdf:
+    def extract_text_and_tables(self, pdf_source):
+        # Una sola apertura con pdfplumber per testo e tabelle dei preventivi
+        with _pdfplumber_open(pdf_source) as pdf:
+            text = ""
             all_tables = []
             for page in pdf.pages:
+                text += page.extract_text() or ""
                 tables = page.extract_tables()
                 if tables:
                     all_tables.extend(tables)
-            return all_tables
+            return text, all_tables
     
-    def detect_type(self, text):
-        if "PREVENTIVO" in text.upper():
+    def detect_type(self, text, text_upper=None):
+        if text_upper is None:
+            text_upper = text.upper()
+        if "PREVENTIVO" in text_upper:
             return "preventivo"
-        elif "PURCHASE ORDER" in text.upper():
+        elif "PURCHASE ORDER" in text_upper:
             return "purchase_order"
         return None
     
     def parse_preventivo(self, text, filename, tables=None):
         data = {
-            'id': datetime.now().strftime('%Y%m%d%H%M%S%f'),
+            'id': str(next(_id_counter)),
             'type': 'preventivo',
             'filename': filename,
             'pratica_fornitore': None,
@@ -162,28 +602,29 @@ class HertzProcessor:
             'data_caricamento': datetime.now().isoformat()
         }
         
-        match = re.search(r'Pratica Fornitore:\s*(\d+)', text)
+        match = _RE_PRATICA_FORNITORE.search(text)
         if match: data['pratica_fornitore'] = match.group(1)
         
-        match = re.search(r'Pratica Hertz:\s*(\d+)', text)
+        match = _RE_PRATICA_HERTZ.search(text)
         if match: data['pratica_hertz'] = match.group(1)
         
-        match = re.search(r'Targa:\s*([A-Z0-9]+)', text)
+        match = _RE_TARGA.search(text)
         if match: data['targa'] = match.group(1).rstrip('T')
         
-        match = re.search(r'Telaio:\s*([A-Z0-9]+)', text)
+        match = _RE_TELAIO.search(text)
         if match: data['telaio'] = match.group(1)
         
-        match = re.search(r'Km:\s*(\d+)', text)
+        match = _RE_KM.search(text)
         if match: data['km'] = match.group(1)
         
-        match = re.search(r'Veicolo \(Marca - Modello - Versione\):\s*([^\n]+)', text)
+        match = _RE_VEICOLO.search(text)
         if match: data['veicolo'] = match.group(1).strip()
         
+        manodopera = []
         if tables:
-            data['items'] = self._extract_items_from_table(tables)
+            data['items'], manodopera = self._extract_items_from_table(tables)
         
-        match = re.search(r'Smaltimento Rifiuti[^\d]*(€?[\d.,]+)', text)
+        match = _RE_SMALTIMENTO.search(text)
         if match:
             try:
                 val = float(match.group(1).replace('€', '').replace(',', '.').strip())
@@ -194,76 +635,72 @@ class HertzProcessor:
                     })
             except: pass
         
-        if tables:
-            for table in tables:
-                for row in table:
-                    if not row: continue
-                    row_text = ' '.join(str(c) for c in row if c)
-                    
-                    for tipo in ['meccanica', 'carrozzeria', 'verniciatura']:
-                        if f'Manodopera {tipo}' in row_text:
-                            match = re.search(r'ore\s+([\d.,]+)\s*x\s*([\d.,]+)', row_text)
-                            if match:
-                                try:
-                                    ore = float(match.group(1).replace(',', '.'))
-                                    tariffa = float(match.group(2).replace(',', '.'))
-                                    totale = ore * tariffa
-                                    if totale > 0 and not any(f'Manodopera {tipo}' in i['description'] for i in data['items']):
-                                        data['items'].append({
-                                            'description': f'Manodopera {tipo} ({ore}h x {tariffa}€/h)',
-                                            'qty': 1, 'price': totale, 'discount': 0, 'total': totale
-                                        })
-                                except: pass
+        for tipo, ore, tariffa in manodopera:
+            try:
+                ore = float(ore.replace(',', '.'))
+                tariffa = float(tariffa.replace(',', '.'))
+                totale = ore * tariffa
+                if totale > 0 and not any(f'Manodopera {tipo}' in i['description'] for i in data['items']):
+                    data['items'].append({
+                        'description': f'Manodopera {tipo} ({ore}h x {tariffa}€/h)',
+                        'qty': 1, 'price': totale, 'discount': 0, 'total': totale
+                    })
+            except: pass
         
         data['totale'] = sum(item['total'] for item in data['items'])
         return data
     
     def _extract_items_from_table(self, tables):
+        """Voci del preventivo e righe di manodopera (tipo, ore, tariffa) in un solo passaggio"""
         items = []
+        manodopera = []
         for table in tables:
             for row in table:
-                if not row or len(row) < 20: continue
+                if not row: continue
+                row_text = ' '.join(str(cell) for cell in row if cell)
+                
+                for tipo in _MANODOPERA_TIPI:
+                    if f'Manodopera {tipo}' in row_text:
+                        match = _RE_MANODOPERA_ORE.search(row_text)
+                        if match:
+                            manodopera.append((tipo, match.group(1), match.group(2)))
+                
+                if len(row) < 20: continue
                 row = [cell if cell else '' for cell in row]
                 
-                if any(h in str(row) for h in ['C.R.', 'Voci di Danno', 'IMPONIBILE', 'Totale tempi']): continue
+                if any(h in row_text for h in _TABLE_HEADER_TOKENS): continue
                 
-                try:
-                    codice = str(row[0]).strip() if row[0] else None
-                    desc = str(row[1]).strip() if row[1] else None
-                    if not desc: continue
-                    
-                    if any(kw in desc for kw in ['Ricambi', 'Materiale', 'Smaltimento', 'Manodopera', 'TOTALI', 'Note:']): continue
-                    
-                    def parse_num(s):
-                        if not s: return 0
-                        try: return float(str(s).replace(',', '.').replace('€', '').strip())
-                        except: return 0
-                    
-                    tempo = parse_num(row[18] if len(row) > 18 else '')
-                    qty = parse_num(row[19] if len(row) > 19 else '')
-                    prezzo = parse_num(row[20] if len(row) > 20 else '')
-                    sconto = parse_num(row[23] if len(row) > 23 else '0')
-                    totale = parse_num(row[24] if len(row) > 24 else '')
-                    
-                    if qty == 0 and tempo > 1: qty = tempo
-                    if qty == 0: qty = 1
-                    
-                    if totale > 0:
-                        full_desc = f"{desc} - C.R: {codice}" if codice else desc
-                        items.append({
-                            'description': full_desc,
-                            'qty': int(qty) if qty == int(qty) else qty,
-                            'price': prezzo,
-                            'discount': int(sconto) if sconto else 0,
-                            'total': totale,
-                            'codice_ricambio': codice
-                        })
-                except: continue
-        return items
-    
-    def parse_purchase_order(self, text, filename):
+                codice = str(row[0]).strip() if row[0] else None
+                desc = str(row[1]).strip() if row[1] else None
+                if not desc: continue
+                
+                if any(kw in desc for kw in _TABLE_SKIP_KEYWORDS): continue
+                
+                # len(row) >= 20: le colonne 18 e 19 esistono sempre
+                tempo = _parse_num(row[18])
+                qty = _parse_num(row[19])
+                prezzo = _parse_num(row[20] if len(row) > 20 else '')
+                sconto = _parse_num(row[23] if len(row) > 23 else '0')
+                totale = _parse_num(row[24] if len(row) > 24 else '')
+                
+                if qty == 0 and tempo > 1: qty = tempo
+                if qty == 0: qty = 1
+                
+                if totale > 0:
+                    full_desc = f"{desc} - C.R: {codice}" if codice else desc
+                    items.append({
+                        'description': full_desc,
+                        'qty': int(qty) if qty == int(qty) else qty,
+                        'price': prezzo,
+                        'discount': int(sconto) if sconto else 0,
+                        'total': totale,
+                        'codice_ricambio': codice
+                    })
+        return items, manodopera
+    
+    def parse_purchase_order(self, text, filename, text_upper=None):
         data = {
-            'id': datetime.now().strftime('%Y%m%d%H%M%S%f'),
+            'id': str(next(_id_counter)),
             'type': 'purchase_order',
             'filename': filename,
             'po_number': None,
@@ -280,131 +717,169 @@ class HertzProcessor:
             'data_caricamento': datetime.now().isoformat()
         }
         
-        match = re.search(r'PURCHASE ORDER #.*?(\d+)', text, re.DOTALL)
+        match = _RE_PO_NUMBER.search(text)
         if match: data['po_number'] = match.group(1)
         
-        match = re.search(r'WD:\s*(\d+)', text)
+        match = _RE_WD.search(text)
         if match: data['pratica_hertz'] = match.group(1)
         
-        match = re.search(r'Plate Number:\s*([A-Z0-9]+)', text)
+        match = _RE_PLATE.search(text)
         if match: data['targa'] = match.group(1)
         
-        match = re.search(r'Serial Number \(VIN\):\s*([A-Z0-9]+)', text)
+        match = _RE_VIN.search(text)
         if match: data['vin'] = match.group(1)
         
-        match = re.search(r'Unit Number:\s*(\d+)', text)
+        match = _RE_UNIT.search(text)
         if match: data['unit_number'] = match.group(1)
         
-        match = re.search(r'Model:\s*([^\n]+)', text)
+        match = _RE_MODEL.search(text)
         if match: data['model'] = match.group(1).strip()
         
-        match = re.search(r'Mileage:\s*(\d+)', text)
+        match = _RE_MILEAGE.search(text)
         if match: data['mileage'] = match.group(1)
         
-        match = re.search(r'TOTAL\s+€\s*([\d.]+)', text)
+        match = _RE_TOTAL.search(text)
         if match: data['total'] = float(match.group(1))
         
         # Estrai la data dal PO (formato: Date: DD/MM/YYYY o simili)
-        match = re.search(r'Date:\s*(\d{1,2}[/-]\d{1,2}[/-]\d{4})', text)
-        if match: 
-            date_str = match.group(1)
-            # Prova a parsare la data in vari formati
-            for fmt in ['%d/%m/%Y', '%d-%m-%Y', '%m/%d/%Y', '%m-%d-%Y']:
-                try:
-                    parsed_date = datetime.strptime(date_str, fmt)
-                    data['date'] = parsed_date.strftime('%Y-%m-%d')
-                    break
-                except ValueError:
-                    continue
+        match = _RE_PO_DATE.search(text)
+        if match:
+            data['date'] = _date_from_match(match)
         
         # Se non trova "Date:", cerca altri pattern comuni
         if not data['date']:
-            match = re.search(r'(\d{1,2}[/-]\d{1,2}[/-]\d{4})', text)
+            match = _RE_DATE.search(text)
             if match:
-                date_str = match.group(1)
-                for fmt in ['%d/%m/%Y', '%d-%m-%Y', '%m/%d/%Y', '%m-%d-%Y']:
-                    try:
-                        parsed_date = datetime.strptime(date_str, fmt)
-                        data['date'] = parsed_date.strftime('%Y-%m-%d')
-                        break
-                    except ValueError:
-                        continue
+                data['date'] = _date_from_match(match)
         
         # Cerca TYRES nel testo del PO
-        data['has_tyres'] = 'TYRES' in text.upper()
+        if text_upper is None:
+            text_upper = text.upper()
+        data['has_tyres'] = 'TYRES' in text_upper
         data['description'] = text[:500]  # Salva primi 500 caratteri per riferimento
         
         return data
     
-    def process_pdf(self, filepath, filename):
-        text = self.extract_text_from_pdf(filepath)
-        doc_type = self.detect_type(text)
+    def process_pdf(self, pdf_source, filename, content_hash=None):
+        """Elabora un PDF da percorso su disco o da contenuto in memoria (bytes)"""
+        if content_hash is not None:
+            known = self._lookup_hash(content_hash)
+            if known is not None:
+                return known
+        
+        with self._parse_lock:
+            doc, parsed_type = self._parse_pdf(pdf_source, filename)
+        if not doc:
+            return None, None
+        doc_type = self._register_doc(doc, parsed_type)
+        
+        # Nell'indice vanno solo i documenti in attesa: quelli già fatturati si rielaborano
+        if content_hash is not None and doc_type == parsed_type:
+            with self._lock:
+                self.data['hash_index'][content_hash] = {
+                    'type': parsed_type,
+                    'pratica_hertz': doc.get('pratica_hertz'),
+                    'po_number': doc.get('po_number'),
+                    'targa': doc.get('targa')
+                }
+                self._dirty = True
+        return doc, doc_type
+    
+    def _lookup_hash(self, content_hash):
+        """Esito di un PDF identico già elaborato, se il documento è ancora in attesa"""
+        with self._lock:
+            entry = self.data['hash_index'].get(content_hash)
+            if entry is None:
+                return None
+            doc = {k: entry[k] for k in ('pratica_hertz', 'po_number', 'targa')}
+            if entry['type'] == 'preventivo':
+                present = doc['pratica_hertz'] in self._preventivi_pratiche
+            else:
+                present = doc['po_number'] in self._po_numbers
+            if present:
+                return doc, entry['type']
+            # Documento eliminato o fatturato nel frattempo: va rielaborato
+            return None
+    
+    def _parse_pdf(self, pdf_source, filename):
+        """Estrae tipo e dati del documento, senza modificare lo stato del processor"""
+        # Una sola apertura con PyMuPDF: il tipo dall'intestazione (prima pagina),
+        # le pagine successive solo se il testo serve (i preventivi passano da pdfplumber)
+        with _fitz_open(pdf_source) as pdf:
+            pages = [pdf[0].get_text("text")] if pdf.page_count else []
+            doc_type = self.detect_type(pages[0]) if pages else None
+            if doc_type != "preventivo":
+                pages.extend(pdf[i].get_text("text") for i in range(1, pdf.page_count))
+        text = "".join(pages)
+        text_upper = None
+        if doc_type is None:
+            # Intestazione non riconosciuta: prova sul testo completo
+            text_upper = text.upper()
+            doc_type = self.detect_type(text, text_upper)
         
         if doc_type == "preventivo":
-            tables = self.extract_tables_from_pdf(filepath)
-            doc = self.parse_preventivo(text, filename, tables)
-            
-            # Controlla se già fatturato
-            fatturati = [f.get('pratica_hertz') for f in self.data['fatture_generate']]
-            if doc['pratica_hertz'] in fatturati:
-                doc['gia_fatturato'] = True
-                return doc, "preventivo_fatturato"
-            
-            existing = [p['pratica_hertz'] for p in self.data['preventivi']]
-            if doc['pratica_hertz'] not in existing:
-                self.data['preventivi'].append(doc)
-                self.save_data()
-            return doc, "preventivo"
-            
+            text, tables = self.extract_text_and_tables(pdf_source)
+            return self.parse_preventivo(text, filename, tables), doc_type
+        
         elif doc_type == "purchase_order":
-            doc = self.parse_purchase_order(text, filename)
-            
-            # Controlla se già fatturato
-            fatturati = [f.get('po_number') for f in self.data['fatture_generate']]
-            if doc['po_number'] in fatturati:
-                doc['gia_fatturato'] = True
-                return doc, "purchase_order_fatturato"
-            
-            existing = [p['po_number'] for p in self.data['purchase_orders']]
-            if doc['po_number'] not in existing:
-                self.data['purchase_orders'].append(doc)
-                self.save_data()
-            return doc, "purchase_order"
+            return self.parse_purchase_order(text, filename, text_upper), doc_type
         
         return None, None
     
+    def _register_doc(self, doc, doc_type):
+        """Aggiunge il documento estratto ai dati, se non è già presente o fatturato"""
+        with self._lock:
+            if doc_type == "preventivo":
+                # Controlla se già fatturato
+                if doc['pratica_hertz'] in self._invoiced_pratiche:
+                    doc['gia_fatturato'] = True
+                    return "preventivo_fatturato"
+                
+                if doc['pratica_hertz'] not in self._preventivi_pratiche:
+                    self.data['preventivi'].append(doc)
+                    self._preventivi_pratiche.add(doc['pratica_hertz'])
+                    self._mark_changed()
+            else:
+                # Controlla se già fatturato
+                if doc['po_number'] in self._invoiced_po:
+                    doc['gia_fatturato'] = True
+                    return "purchase_order_fatturato"
+                
+                if doc['po_number'] not in self._po_numbers:
+                    self.data['purchase_orders'].append(doc)
+                    self._po_numbers.add(doc['po_number'])
+                    self._mark_changed()
+        return doc_type
+    
     def generate_xml(self, match):
+        # Numerazione e dati aggiornati in modo atomico (anche da operazioni in background)
+        with self._lock:
+            result = self._write_invoice(match)
+            self._remove_invoiced([match])
+            self.save_data()
+            return result
+    
+    def generate_xml_batch(self, matches, progress=None):
+        """Genera le fatture in ordine con un solo salvataggio finale"""
+        generated, done = [], []
+        with self._lock:
+            for match in matches:
+                try:
+                    filename, totale = self._write_invoice(match)
+                    generated.append({'filename': filename, 'totale': totale})
+                    done.append(match)
+                except: pass
+                if progress: progress()
+            if done:
+                self._remove_invoiced(done)
+                self.save_data()
+        return generated
+    
+    def _write_invoice(self, match):
         prev = match['preventivo']
         po = match['po']
-        
-        root = ET.Element('EasyfattDocuments')
-        
-        company = ET.SubElement(root, 'Company')
-        ET.SubElement(company, 'Name').text = 'SCHIAVI GOMME SRL'
-        ET.SubElement(company, 'Address').text = 'VIA UTA 20'
-        ET.SubElement(company, 'Postcode').text = '00133'
-        ET.SubElement(company, 'City').text = 'ROMA'
-        ET.SubElement(company, 'Province').text = 'RM'
-        ET.SubElement(company, 'FiscalCode').text = '13021431005'
-        ET.SubElement(company, 'VatCode').text = '13021431005'
-        ET.SubElement(company, 'Tel').text = '0622152148'
-        ET.SubElement(company, 'Email').text = 'schiavigomme@gmail.com'
-        
-        documents = ET.SubElement(root, 'Documents')
-        document = ET.SubElement(documents, 'Document')
-        
-        ET.SubElement(document, 'CustomerCode').text = '999999'
-        ET.SubElement(document, 'CustomerName').text = 'HERTZ ITALIANA S.R.L.'
-        ET.SubElement(document, 'CustomerAddress').text = 'VIA DEL CASALE CAVALLARI, 204'
-        ET.SubElement(document, 'CustomerPostcode').text = '00156'
-        ET.SubElement(document, 'CustomerCity').text = 'ROMA'
-        ET.SubElement(document, 'CustomerProvince').text = 'RM'
-        ET.SubElement(document, 'CustomerCountry').text = 'IT'
-        ET.SubElement(document, 'CustomerFiscalCode').text = '00433120581'
-        ET.SubElement(document, 'CustomerVatCode').text = 'IT00890931009'
-        
-        ET.SubElement(document, 'DocumentType').text = 'I'
-        ET.SubElement(document, 'Date').text = datetime.now().strftime('%Y-%m-%d')
+        if self.is_po_invoiced(po['po_number']):
+            raise ValueError(f"PO {po['po_number']} già fatturato")
         
         current_year = datetime.now().year
         if self.data['config']['year'] != current_year:
@@ -424,53 +899,7 @@ class HertzProcessor:
             invoice_number = self.data['config']['last_number_hm']
             numbering_suffix = 'HM'
         
-        ET.SubElement(document, 'Number').text = str(invoice_number)
-        ET.SubElement(document, 'Numbering').text = f"/{numbering_suffix}"
-        
-        total_without_tax = sum(item['total'] for item in prev['items'])
-        vat_amount = total_without_tax * 0.22
-        total = total_without_tax + vat_amount
-        
-        ET.SubElement(document, 'TotalWithoutTax').text = f"{total_without_tax:.2f}"
-        ET.SubElement(document, 'VatAmount').text = f"{vat_amount:.2f}"
-        ET.SubElement(document, 'Total').text = f"{total:.2f}"
-        ET.SubElement(document, 'PricesIncludeVat').text = 'false'
-        ET.SubElement(document, 'PaymentName').text = 'Bonifico 60 gg'
-        
-        # Aggiungo Commento con PO e Targa
-        targa = prev.get('targa') or po.get('targa') or ''
-        ET.SubElement(document, 'InternalComment').text = f"PO: {po['po_number']} - Targa: {targa}"
-        
-        rows = ET.SubElement(document, 'Rows')
-        
-        row_vehicle = ET.SubElement(rows, 'Row')
-        vehicle_desc = f"""PO Number: {po['po_number']}
-Plate Number: {po['targa']}
-Serial Number (VIN): {po['vin']}
-Unit Number: {po['unit_number']}
-Model: {po['model']}
-Country: IT
-Type: L
-Mileage: {po['mileage']}
-Car/Van: V
-Pratica Hertz: {prev['pratica_hertz']}"""
-        ET.SubElement(row_vehicle, 'Description').text = vehicle_desc
-        
-        for item in prev['items']:
-            row = ET.SubElement(rows, 'Row')
-            if item.get('codice_ricambio'):
-                ET.SubElement(row, 'Code').text = item['codice_ricambio']
-            ET.SubElement(row, 'Description').text = item['description']
-            ET.SubElement(row, 'Qty').text = str(item['qty'])
-            ET.SubElement(row, 'Price').text = f"{item['price']:.2f}"
-            if item['discount'] > 0:
-                ET.SubElement(row, 'Discounts').text = f"{item['discount']:.2f}%"
-            ET.SubElement(row, 'VatCode', Perc="22.0", Class="Imponibile")
-            ET.SubElement(row, 'Total').text = f"{item['total']:.2f}"
-        
-        rough_string = ET.tostring(root, encoding='utf-8')
-        reparsed = minidom.parseString(rough_string)
-        xml_string = reparsed.toprettyxml(indent="  ", encoding='utf-8').decode('utf-8')
+        xml_bytes, total = _render_xml(prev, po, invoice_number, numbering_suffix)
         
         # Nome file con Data, PO e targa
         targa = prev.get('targa') or po.get('targa') or 'NOTARGA'
@@ -491,10 +920,10 @@ Pratica Hertz: {prev['pratica_hertz']}"""
         filename = f"Fatt_{invoice_str}_PO_{po['po_number']}_{targa}.xml"
         filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(xml_string)
+        with open(filepath, 'wb') as f:
+            f.write(xml_bytes)
         
-        self.data['fatture_generate'].append({
+        self.append_fattura({
             'po_number': po['po_number'],
             'targa': targa,
             'pratica_hertz': prev['pratica_hertz'],
@@ -505,27 +934,167 @@ Pratica Hertz: {prev['pratica_hertz']}"""
             'data_po': po_date,  # Salva la data del PO
             'data_generazione': datetime.now().isoformat()
         })
-        
-        self.data['preventivi'] = [p for p in self.data['preventivi'] if p['pratica_hertz'] != prev['pratica_hertz']]
-        self.data['purchase_orders'] = [p for p in self.data['purchase_orders'] if p['po_number'] != po['po_number']]
-        
-        self.save_data()
+        self._invoiced_pratiche.add(prev['pratica_hertz'])
+        self._invoiced_po.add(po['po_number'])
         return filename, total
     
+    def _remove_invoiced(self, matches):
+        """Toglie preventivi e PO fatturati con un solo passaggio sulle liste"""
+        pratiche = {m['preventivo']['pratica_hertz'] for m in matches}
+        po_numbers = {m['po']['po_number'] for m in matches}
+        self.data['preventivi'] = [p for p in self.data['preventivi'] if p['pratica_hertz'] not in pratiche]
+        self.data['purchase_orders'] = [p for p in self.data['purchase_orders'] if p['po_number'] not in po_numbers]
+        self._preventivi_pratiche -= pratiche
+        self._po_numbers -= po_numbers
+        self._prune_hash_index()
+    
     def delete_document(self, doc_type, doc_id):
-        if doc_type == 'preventivo':
-            self.data['preventivi'] = [p for p in self.data['preventivi'] if p['id'] != doc_id]
-        elif doc_type == 'purchase_order':
-            self.data['purchase_orders'] = [p for p in self.data['purchase_orders'] if p['id'] != doc_id]
-        self.save_data()
+        with self._lock:
+            if doc_type == 'preventivo':
+                self.data['preventivi'] = [p for p in self.data['preventivi'] if p['id'] != doc_id]
+            elif doc_type == 'purchase_order':
+                self.data['purchase_orders'] = [p for p in self.data['purchase_orders'] if p['id'] != doc_id]
+            self.rebuild_indexes()
+            self.save_data()
     
     def clear_all(self):
-        self.data['preventivi'] = []
-        self.data['purchase_orders'] = []
-        self.save_data()
+        with self._lock:
+            self.data['preventivi'] = []
+            self.data['purchase_orders'] = []
+            self.rebuild_indexes()
+            self.save_data()
+    
+    def delete_all_fatture(self):
+        """Svuota l'elenco fatture e restituisce quelle eliminate"""
+        with self._lock:
+            deleted = self.data['fatture_generate']
+            self.data['fatture_generate'] = []
+            self.rebuild_indexes()
+            self.save_fatture()
+            self.save_data()
+            return deleted
+    
+    def sblocca_pratica(self, pratica_hertz):
+        """Elimina le fatture della pratica; restituisce la prima trovata o None"""
+        with self._lock:
+            fattura = next((f for f in self.data['fatture_generate']
+                            if f.get('pratica_hertz') == pratica_hertz), None)
+            if fattura is None:
+                return None
+            self.data['fatture_generate'] = [
+                f for f in self.data['fatture_generate']
+                if f.get('pratica_hertz') != pratica_hertz
+            ]
+            self.rebuild_indexes()
+            self.save_fatture()
+            self.save_data()
+            return fattura
+    
+    def _get_imap(self, email_config):
+        """Riusa la connessione IMAP aperta se ancora attiva, altrimenti ne apre una nuova"""
+        credentials = (email_config['email'], email_config['password'])
+        if self._imap is not None and self._imap_credentials == credentials:
+            try:
+                if self._imap.noop()[0] == 'OK':
+                    return self._imap
+            except Exception:
+                pass
+        self._close_imap()
+        
+        mail_conn = imaplib.IMAP4_SSL('imap.gmail.com', 993)
+        try:
+            mail_conn.login(*credentials)
+        except Exception:
+            try:
+                mail_conn.logout()
+            except:
+                pass
+            raise
+        self._imap = mail_conn
+        self._imap_credentials = credentials
+        if self._imap_reaper is None:
+            self._imap_reaper = threading.Thread(target=self._reap_idle_imap, daemon=True)
+            self._imap_reaper.start()
+        return mail_conn
+    
+    def _close_imap(self):
+        if self._imap is not None:
+            try:
+                self._imap.logout()
+            except:
+                pass
+        self._imap = None
+        self._imap_credentials = None
+    
+    def _reap_idle_imap(self):
+        """Chiude la connessione IMAP rimasta inutilizzata oltre IMAP_IDLE_TIMEOUT"""
+        while True:
+            time.sleep(60)
+            with self._imap_lock:
+                if self._imap is not None and time.time() - self._imap_last_used > IMAP_IDLE_TIMEOUT:
+                    self._close_imap()
+    
+    def _fetch_headers(self, mail_conn, email_uids, batch_size=500):
+        """Scarica From/Subject di più email con un solo FETCH per blocco, senza allegati"""
+        headers = {}
+        for i in range(0, len(email_uids), batch_size):
+            uid_set = b','.join(email_uids[i:i + batch_size]).decode()
+            status, msg_data = mail_conn.uid('FETCH', uid_set, '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])')
+            if status != 'OK': continue
+            for item in msg_data:
+                if isinstance(item, tuple):
+                    match = _RE_IMAP_UID.search(item[0])
+                    if match:
+                        headers[match.group(1)] = email.message_from_bytes(item[1])
+        return headers
+    
+    def _process_email_pdf(self, payload, safe_filename, filename, subject, from_header, po_scaricati, results):
+        """Elabora un allegato PDF scaricato da email"""
+        doc, doc_type, error = None, None, None
+        try:
+            # Parsing direttamente dai bytes dell'allegato, senza passare dal disco
+            doc, doc_type = self.process_pdf(payload, safe_filename)
+        except Exception as e:
+            error = e
+        po_number = doc.get('po_number') if doc else None
+        
+        with self._lock:
+            if po_number and po_number in po_scaricati:
+                results['duplicati'] += 1
+                results['skipped'].append(f"PO {po_number} già scaricato")
+                return
+            
+            # Archivia l'allegato in uploads (i duplicati non vengono salvati)
+            with open(os.path.join(app.config['UPLOAD_FOLDER'], safe_filename), 'wb') as f:
+                f.write(payload)
+            
+            if error is not None:
+                results['errors'].append(f"{filename}: {str(error)}")
+                return
+            if not doc: return
+            
+            if po_number:
+                po_scaricati.add(po_number)
+            
+            results['downloaded'] += 1
+            results['files'].append({
+                'filename': safe_filename,
+                'type': doc_type,
+                'subject': subject,
+                'from': from_header,
+                'po_number': po_number
+            })
     
     def check_email(self, data_da=None):
         """Controlla Gmail per nuovi PO via IMAP"""
+        # Un controllo alla volta sulla connessione condivisa
+        with self._imap_lock:
+            try:
+                return self._check_email(data_da)
+            finally:
+                self._imap_last_used = time.time()
+    
+    def _check_email(self, data_da):
         email_config = self.data.get('email_config', {})
         
         if not email_config.get('password'):
@@ -535,7 +1104,7 @@ Pratica Hertz: {prev['pratica_hertz']}"""
             return {'error': 'Email non configurata. Vai in Configurazione.'}
         
         # Lista PO già scaricati
-        po_scaricati = email_config.get('po_scaricati', [])
+        po_scaricati = email_config.get('po_scaricati', set())
         
         results = {
             'checked': 0,
@@ -546,15 +1115,34 @@ Pratica Hertz: {prev['pratica_hertz']}"""
             'duplicati': 0
         }
         
-        mail_conn = None
+        completed = False
+        deferred_save = False
         try:
             import socket
             socket.setdefaulttimeout(30)  # Timeout 30 secondi
             
-            mail_conn = imaplib.IMAP4_SSL('imap.gmail.com', 993)
-            mail_conn.login(email_config['email'], email_config['password'])
+            mail_conn = self._get_imap(email_config)
             mail_conn.select('inbox')
             
+            # Gli UID restano validi finché il server non cambia UIDVALIDITY
+            uidvalidity = mail_conn.response('UIDVALIDITY')[1][0]
+            uidvalidity = uidvalidity.decode() if uidvalidity else None
+            last_uid = email_config.get('last_uid_seen') or 0
+            if uidvalidity != email_config.get('uidvalidity'):
+                last_uid = 0
+            uidnext = mail_conn.response('UIDNEXT')[1][0]
+            uidnext = int(uidnext) if uidnext else None
+            
+            # UIDNEXT invariato dall'ultimo controllo completo: nessuna email nuova, niente SEARCH
+            if (not data_da and uidnext is not None
+                    and uidvalidity == email_config.get('uidvalidity')
+                    and uidnext == email_config.get('last_uidnext')):
+                self.data['email_config']['ultimo_controllo'] = datetime.now().isoformat()
+                self.schedule_save()
+                deferred_save = True
+                completed = True
+                return results
+            
             mittente = email_config.get('mittente_filtro', '').strip()
             oggetto = email_config.get('oggetto_filtro', 'PO')
             
@@ -565,20 +1153,38 @@ Pratica Hertz: {prev['pratica_hertz']}"""
                     data_da = data_da.replace('-', '/')
                 gmail_query = f'subject:{oggetto} after:{data_da}'
                 print(f"DEBUG Gmail query: {gmail_query}")
-                status, messages = mail_conn.search(None, 'X-GM-RAW', f'"{gmail_query}"')
+                status, messages = mail_conn.uid('SEARCH', None, 'X-GM-RAW', f'"{gmail_query}"')
             else:
-                status, messages = mail_conn.search(None, f'(SUBJECT "{oggetto}")')
+                # Solo le email arrivate dopo l'ultimo controllo
+                status, messages = mail_conn.uid('SEARCH', None, f'UID {last_uid + 1}:*', f'(SUBJECT "{oggetto}")')
             
             if status != 'OK':
                 return {'error': 'Errore nella ricerca email'}
             
             email_ids = messages[0].split()
+            if not data_da:
+                # "UID n:*" restituisce sempre almeno l'ultimo messaggio, anche se già visto
+                email_ids = [uid for uid in email_ids if int(uid) > last_uid]
             results['checked'] = len(email_ids)
+            failed_uids = []
             
+            # Con filtro mittente scarica prima solo gli header, in blocco
+            headers = self._fetch_headers(mail_conn, email_ids) if mittente else {}
+            
+            # Download ed elaborazione in sequenza (PyMuPDF non supporta l'uso da più thread)
             for email_id in email_ids:
                 try:
-                    status, msg_data = mail_conn.fetch(email_id, '(RFC822)')
-                    if status != 'OK': continue
+                    header_msg = headers.get(email_id)
+                    if header_msg is not None:
+                        from_header = header_msg.get('From', '')
+                        if mittente.lower() not in from_header.lower():
+                            results['skipped'].append(f"Mittente non corrisponde: {from_header}")
+                            continue
+                    
+                    status, msg_data = mail_conn.uid('FETCH', email_id, '(RFC822)')
+                    if status != 'OK':
+                        failed_uids.append(int(email_id))
+                        continue
                     
                     msg = email.message_from_bytes(msg_data[0][1])
                     from_header = msg.get('From', '')
@@ -619,56 +1225,37 @@ Pratica Hertz: {prev['pratica_hertz']}"""
                             if filename.lower().endswith('.pdf'):
                                 found_pdf = True
                                 safe_filename = secure_filename(filename)
-                                filepath = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
                                 
                                 payload = part.get_payload(decode=True)
                                 if payload:
-                                    with open(filepath, 'wb') as f:
-                                        f.write(payload)
-                                    
-                                    try:
-                                        doc, doc_type = self.process_pdf(filepath, safe_filename)
-                                        if doc:
-                                            po_number = doc.get('po_number')
-                                            
-                                            if po_number and po_number in po_scaricati:
-                                                results['duplicati'] += 1
-                                                results['skipped'].append(f"PO {po_number} già scaricato")
-                                                os.remove(filepath)
-                                                continue
-                                            
-                                            if po_number:
-                                                po_scaricati.append(po_number)
-                                            
-                                            results['downloaded'] += 1
-                                            results['files'].append({
-                                                'filename': safe_filename,
-                                                'type': doc_type,
-                                                'subject': subject,
-                                                'from': from_header,
-                                                'po_number': po_number
-                                            })
-                                    except Exception as e:
-                                        results['errors'].append(f"{filename}: {str(e)}")
+                                    self._process_email_pdf(payload, safe_filename, filename,
+                                                            subject, from_header, po_scaricati, results)
                                 else:
                                     results['errors'].append(f"{filename}: payload vuoto")
                     
                     if not found_pdf:
                         results['skipped'].append(f"Nessun PDF in: {subject}")
-                    
+                
                 except Exception as e:
                     results['errors'].append(str(e))
+                    failed_uids.append(int(email_id))
             
-            try:
-                mail_conn.logout()
-            except:
-                pass
+            # Avanza fino all'ultima email letta, fermandosi prima di quelle da riprovare
+            if not data_da:
+                seen = [int(uid) for uid in email_ids]
+                if failed_uids:
+                    seen = [uid for uid in seen if uid < min(failed_uids)]
+                self.data['email_config']['last_uid_seen'] = max(seen, default=last_uid)
+                self.data['email_config']['uidvalidity'] = uidvalidity
+                # Con email da riprovare il prossimo controllo non può essere saltato
+                self.data['email_config']['last_uidnext'] = None if failed_uids else uidnext
             
             # Salva lista PO scaricati
             self.data['email_config']['po_scaricati'] = po_scaricati
             self.data['email_config']['ultimo_controllo'] = datetime.now().isoformat()
             self.save_data()
             
+            completed = True
             return results
             
         except imaplib.IMAP4.error as e:
@@ -683,14 +1270,100 @@ Pratica Hertz: {prev['pratica_hertz']}"""
         except Exception as e:
             return {'error': f'Errore: {str(e)}'}
         finally:
-            if mail_conn:
-                try:
-                    mail_conn.logout()
-                except:
-                    pass
+            # La connessione resta aperta per il prossimo controllo, salvo errori
+            if not completed:
+                self._close_imap()
+            # Salva eventuali PDF elaborati prima di un errore (salvo salvataggio già differito)
+            if not deferred_save:
+                self.flush()
 
 
 processor = HertzProcessor()
+# Le modifiche ancora in attesa del salvataggio differito vanno scritte all'uscita
+atexit.register(processor.flush)
+
+
+# ==================== OPERAZIONI IN BACKGROUND ====================
+
+_task_executor = ThreadPoolExecutor(max_workers=2)
+_tasks = {}
+_tasks_lock = threading.Lock()
+TASK_RETENTION = 600  # secondi di conservazione dei risultati
+
+
+def submit_task(fn, *args):
+    """Esegue fn(task, *args) in background e restituisce l'id da interrogare su /task-status"""
+    task_id = uuid.uuid4().hex
+    task = {'state': 'PENDING', 'current': 0, 'total': 0, 'result': None, 'error': None, 'finished': None}
+    with _tasks_lock:
+        # Elimina i risultati vecchi già consegnati
+        now = time.time()
+        for old_id in [t for t, v in _tasks.items() if v['finished'] and now - v['finished'] > TASK_RETENTION]:
+            del _tasks[old_id]
+        _tasks[task_id] = task
+    
+    def run():
+        task['state'] = 'STARTED'
+        try:
+            task['result'] = fn(task, *args)
+            task['state'] = 'SUCCESS'
+        except Exception as e:
+            task['error'] = str(e)
+            task['state'] = 'FAILURE'
+        task['finished'] = time.time()
+    
+    _task_executor.submit(run)
+    return task_id
+
+
+def _upload_one(filepath, filename, content_hash):
+    try:
+        doc, doc_type = processor.process_pdf(filepath, filename, content_hash)
+        if not doc:
+            return {'filename': filename, 'error': 'Tipo non riconosciuto'}
+        result = {
+            'filename': filename,
+            'type': doc_type,
+            'targa': doc.get('targa'),
+            'pratica': doc.get('pratica_hertz'),
+            'po_number': doc.get('po_number')
+        }
+        # Segnala se già fatturato
+        if doc_type in ['preventivo_fatturato', 'purchase_order_fatturato']:
+            result['gia_fatturato'] = True
+            result['warning'] = f"Documento già fatturato!"
+        return result
+    except Exception as e:
+        return {'filename': filename, 'error': str(e)}
+
+
+def _upload_task(task, saved_files):
+    task['total'] = len(saved_files)
+    results = []
+    
+    # Parsing in sequenza, nell'ordine di caricamento: PyMuPDF non supporta l'uso da più thread
+    for filepath, filename, content_hash in saved_files:
+        results.append(_upload_one(filepath, filename, content_hash))
+        task['current'] += 1
+    
+    processor.flush()
+    return {'results': results, 'stats': processor.get_stats()}
+
+
+def _check_email_task(task, data_da):
+    return processor.check_email(data_da)
+
+
+def _genera_tutti_task(task):
+    # Matches ordinati per data PO (più vecchi prima)
+    sorted_matches = processor.get_sorted_matches()
+    task['total'] = len(sorted_matches)
+    
+    def progress():
+        task['current'] += 1
+    
+    generated = processor.generate_xml_batch(sorted_matches, progress)
+    return {'success': True, 'generated': generated}
 
 
 # ==================== ROUTES ====================
@@ -708,8 +1381,7 @@ def lavori():
 @app.route('/documenti')
 def documenti():
     stats = processor.get_stats()
-    docs = processor.data['preventivi'] + processor.data['purchase_orders']
-    docs.sort(key=lambda x: x.get('data_caricamento', ''), reverse=True)
+    docs = processor.get_sorted_documents()
     return render_template('documenti.html', stats=stats, documents=docs, page='documenti')
 
 @app.route('/configurazione')
@@ -725,62 +1397,57 @@ def upload_file():
         return jsonify({'error': 'Nessun file'}), 400
     
     files = request.files.getlist('file')
-    results = []
+    saved_files = []
     
+    # I file vanno salvati durante la richiesta; il parsing prosegue in background
     for file in files:
         if file.filename == '': continue
         
         if file and file.filename.lower().endswith('.pdf'):
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            
-            try:
-                doc, doc_type = processor.process_pdf(filepath, filename)
-                if doc:
-                    result = {
-                        'filename': filename,
-                        'type': doc_type,
-                        'targa': doc.get('targa'),
-                        'pratica': doc.get('pratica_hertz'),
-                        'po_number': doc.get('po_number')
-                    }
-                    # Segnala se già fatturato
-                    if doc_type in ['preventivo_fatturato', 'purchase_order_fatturato']:
-                        result['gia_fatturato'] = True
-                        result['warning'] = f"Documento già fatturato!"
-                    results.append(result)
-                else:
-                    results.append({'filename': filename, 'error': 'Tipo non riconosciuto'})
-            except Exception as e:
-                results.append({'filename': filename, 'error': str(e)})
-    
-    return jsonify({'results': results, 'stats': processor.get_stats()})
+            # Nome univoco su disco: un altro caricamento con lo stesso nome non deve
+            # sovrascrivere il file prima che il job lo elabori
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex[:8]}_{filename}")
+            # Copia su disco calcolando l'hash: i PDF già visti non vengono rielaborati
+            digest = hashlib.blake2b(digest_size=16)
+            with open(filepath, 'wb') as out:
+                while chunk := file.stream.read(UPLOAD_BUFFER_SIZE):
+                    digest.update(chunk)
+                    out.write(chunk)
+            saved_files.append((filepath, filename, digest.hexdigest()))
+    
+    return jsonify({'task_id': submit_task(_upload_task, saved_files)}), 202
 
 @app.route('/check-email', methods=['POST'])
 def check_email():
     try:
         data = request.json or {}
         data_da = data.get('data_da')
-        results = processor.check_email(data_da)
-        return jsonify(results)
+        return jsonify({'task_id': submit_task(_check_email_task, data_da)}), 202
     except Exception as e:
         return jsonify({'error': f'Errore server: {str(e)}'}), 200
 
 @app.route('/save-email-config', methods=['POST'])
 def save_email_config():
     data = request.json
-    processor.data['email_config']['email'] = data.get('email', '')
-    processor.data['email_config']['password'] = data.get('password', '')
-    processor.data['email_config']['mittente_filtro'] = data.get('mittente_filtro', '')
-    processor.data['email_config']['oggetto_filtro'] = data.get('oggetto_filtro', 'PO')
-    processor.save_data()
+    with processor._lock:
+        processor.data['email_config']['email'] = data.get('email', '')
+        processor.data['email_config']['password'] = data.get('password', '')
+        processor.data['email_config']['mittente_filtro'] = data.get('mittente_filtro', '')
+        processor.data['email_config']['oggetto_filtro'] = data.get('oggetto_filtro', 'PO')
+        # Nuovo account o nuovi filtri: il prossimo controllo riparte da capo
+        processor.data['email_config']['last_uid_seen'] = None
+        processor.data['email_config']['last_uidnext'] = None
+        processor.schedule_save()
     return jsonify({'success': True})
 
 @app.route('/reset-po-scaricati', methods=['POST'])
 def reset_po_scaricati():
-    processor.data['email_config']['po_scaricati'] = []
-    processor.save_data()
+    with processor._lock:
+        processor.data['email_config']['po_scaricati'].clear()
+        processor.data['email_config']['last_uid_seen'] = None
+        processor.data['email_config']['last_uidnext'] = None
+        processor.schedule_save()
     return jsonify({'success': True})
 
 @app.route('/update-numerazione', methods=['POST'])
@@ -793,9 +1460,10 @@ def update_numerazione():
         if new_hm < 0 or new_hg < 0:
             return jsonify({'error': 'I numeri devono essere positivi'}), 400
         
-        processor.data['config']['last_number_hm'] = new_hm
-        processor.data['config']['last_number_hg'] = new_hg
-        processor.save_data()
+        with processor._lock:
+            processor.data['config']['last_number_hm'] = new_hm
+            processor.data['config']['last_number_hg'] = new_hg
+            processor.schedule_save()
         
         return jsonify({'success': True})
     except ValueError:
@@ -803,41 +1471,28 @@ def update_numerazione():
 
 @app.route('/genera/<pratica_hertz>', methods=['POST'])
 def genera_fattura(pratica_hertz):
-    stats = processor.get_stats()
+    match = processor.find_match(pratica_hertz)
+    if match is None:
+        return jsonify({'error': 'Match non trovato'}), 404
     
-    for match in stats['matches']:
-        if match['preventivo']['pratica_hertz'] == pratica_hertz:
-            try:
-                filename, totale = processor.generate_xml(match)
-                return jsonify({'success': True, 'filename': filename, 'totale': totale})
-            except Exception as e:
-                return jsonify({'error': str(e)}), 500
-    
-    return jsonify({'error': 'Match non trovato'}), 404
+    try:
+        filename, totale = processor.generate_xml(match)
+        return jsonify({'success': True, 'filename': filename, 'totale': totale})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/genera-tutti', methods=['POST'])
 def genera_tutti():
-    stats = processor.get_stats()
-    generated = []
-    
-    # Ordina i matches per data PO (più vecchi prima)
-    sorted_matches = sorted(stats['matches'], 
-                           key=lambda m: m['po'].get('date') or '9999-99-99')
-    
-    for match in sorted_matches:
-        try:
-            filename, totale = processor.generate_xml(match)
-            generated.append({'filename': filename, 'totale': totale})
-        except: pass
-    
-    return jsonify({'success': True, 'generated': generated})
+    return jsonify({'task_id': submit_task(_genera_tutti_task)}), 202
 
 @app.route('/download/<filename>')
 def download_file(filename):
     filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-    if os.path.exists(filepath):
-        return send_file(filepath, as_attachment=True)
-    return "File non trovato", 404
+    try:
+        # Richieste condizionali (ETag/Last-Modified) e range gestite da send_file
+        return send_file(filepath, as_attachment=True, conditional=True, etag=True)
+    except FileNotFoundError:
+        return "File non trovato", 404
 
 @app.route('/delete/<doc_type>/<doc_id>', methods=['POST'])
 def delete_document(doc_type, doc_id):
@@ -848,17 +1503,11 @@ def delete_document(doc_type, doc_id):
 def delete_fattura(filename):
     try:
         # Rimuovi la fattura dalla lista
-        processor.data['fatture_generate'] = [
-            f for f in processor.data['fatture_generate'] 
-            if f['filename'] != filename
-        ]
+        processor.delete_fattura(filename)
         
         # Elimina il file XML se esiste
-        filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        _safe_unlink(os.path.join(app.config['OUTPUT_FOLDER'], filename))
         
-        processor.save_data()
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -866,22 +1515,21 @@ def delete_fattura(filename):
 @app.route('/delete-all-fatture', methods=['POST'])
 def delete_all_fatture():
     try:
-        deleted_count = len(processor.data['fatture_generate'])
-        
-        # Elimina tutti i file XML
-        for fattura in processor.data['fatture_generate']:
-            filepath = os.path.join(app.config['OUTPUT_FOLDER'], fattura['filename'])
-            if os.path.exists(filepath):
-                try:
-                    os.remove(filepath)
-                except:
-                    pass  # Continua anche se un file non può essere eliminato
-        
         # Svuota la lista fatture
-        processor.data['fatture_generate'] = []
-        processor.save_data()
+        deleted = processor.delete_all_fatture()
+        
+        # Elimina tutti i file XML in parallelo; un file non eliminabile non ferma gli altri
+        output_folder = app.config['OUTPUT_FOLDER']
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {
+                executor.submit(_safe_unlink, os.path.join(output_folder, fattura['filename'])): fattura['filename']
+                for fattura in deleted
+            }
+        for future, filename in futures.items():
+            if future.exception() is not None:
+                print(f"⚠️ Impossibile eliminare {filename}: {future.exception()}")
         
-        return jsonify({'success': True, 'deleted': deleted_count})
+        return jsonify({'success': True, 'deleted': len(deleted)})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -894,31 +1542,16 @@ def clear_all():
 def sblocca_pratica(pratica_hertz):
     """Sblocca una pratica già fatturata per poterla riassociare"""
     try:
-        # Trova la fattura con questa pratica
-        fattura_da_eliminare = None
-        for f in processor.data['fatture_generate']:
-            if f.get('pratica_hertz') == pratica_hertz:
-                fattura_da_eliminare = f
-                break
-        
+        # Elimina la fattura dal JSON
+        fattura_da_eliminare = processor.sblocca_pratica(pratica_hertz)
         if not fattura_da_eliminare:
             return jsonify({'error': 'Fattura non trovata'}), 404
         
-        # Elimina la fattura dal JSON
-        processor.data['fatture_generate'] = [
-            f for f in processor.data['fatture_generate'] 
-            if f.get('pratica_hertz') != pratica_hertz
-        ]
-        
         # Elimina il file XML se esiste
         try:
-            xml_path = os.path.join(app.config['OUTPUT_FOLDER'], fattura_da_eliminare['filename'])
-            if os.path.exists(xml_path):
-                os.remove(xml_path)
-        except:
-            pass
-        
-        processor.save_data()
+            _safe_unlink(os.path.join(app.config['OUTPUT_FOLDER'], fattura_da_eliminare['filename']))
+        except OSError as e:
+            print(f"⚠️ Impossibile eliminare {fattura_da_eliminare['filename']}: {e}")
         
         return jsonify({
             'success': True, 
@@ -928,13 +1561,31 @@ def sblocca_pratica(pratica_hertz):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/task-status/<task_id>')
+def task_status(task_id):
+    task = _tasks.get(task_id)
+    if task is None:
+        return jsonify({'state': 'FAILURE', 'error': 'Operazione non trovata'}), 404
+    return jsonify({k: task[k] for k in ('state', 'current', 'total', 'result', 'error')})
+
 @app.route('/api/stats')
 def api_stats():
+    # Dati invariati dall'ultima risposta al browser: 304 senza ricalcolare nulla
+    etag = processor.data_etag()
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+    
     stats = processor.get_stats()
     stats['po_scaricati'] = len(processor.data.get('email_config', {}).get('po_scaricati', []))
-    return jsonify(stats)
+    response = jsonify(stats)
+    response.set_etag(etag)
+    # no-cache: il browser rivalida sempre, così dopo un upload le statistiche sono subito aggiornate
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 if __name__ == '__main__':
+    # SIGTERM come uscita normale, così atexit salva i dati (gunicorn gestisce già i suoi segnali)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,9 @@
+# Configurazione gunicorn (caricata automaticamente da `gunicorn app:app`)
+
+# Un solo processo: dati, indici e operazioni in background vivono in memoria
+workers = 1
+
+# Più thread nello stesso processo: le richieste in attesa di IMAP/disco
+# non bloccano il polling di /task-status e /api/stats
+worker_class = 'gthread'
+threads = 8
@@ -0,0 +1,154 @@
+"""Recupero dei dati all'avvio: file fatture JSONL, documenti fatturati, numerazione HG/HM
+
+Esecuzione: python -m unittest discover tests
+"""
+import os
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+YEAR = 2026
+
+app = None
+_cwd = None
+_tmp = None
+
+
+def setUpModule():
+    # app.py crea dati e cartelle nella directory corrente all'import
+    global app, _cwd, _tmp
+    _cwd = os.getcwd()
+    _tmp = tempfile.TemporaryDirectory()
+    os.chdir(_tmp.name)
+    sys.path.insert(0, str(ROOT))
+    import app as app_module
+    app = app_module
+
+
+def tearDownModule():
+    os.chdir(_cwd)
+    _tmp.cleanup()
+
+
+def fattura(numero, tipo='HM', pratica=None, po=None):
+    return {
+        'po_number': po or f'PO{tipo}{numero}',
+        'pratica_hertz': pratica or f'P{tipo}{numero}',
+        'filename': f'Fatt_{numero:03d}_{tipo}.xml',
+        'numero_fattura': numero,
+        'tipo': tipo,
+        'data_generazione': f'{YEAR}-03-01T10:00:00',
+    }
+
+
+class LoadDataTestCase(unittest.TestCase):
+    """Ogni test lavora in una directory vuota con i propri file dati"""
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        os.chdir(self._dir.name)
+
+    def tearDown(self):
+        os.chdir(_tmp.name)
+        self._dir.cleanup()
+
+    def new_processor(self, fatture, last_hm=0, last_hg=0):
+        """Avvio da zero con le fatture già generate e i contatori indicati, poi salvataggio"""
+        processor = app.HertzProcessor()
+        for f in fatture:
+            processor.append_fattura(f)
+        processor.data['config'].update(year=YEAR, last_number_hm=last_hm, last_number_hg=last_hg)
+        processor.save_data()
+        return processor
+
+
+class LoadFattureTest(LoadDataTestCase):
+    def test_torn_last_line_is_dropped_and_file_rewritten(self):
+        self.new_processor([fattura(1), fattura(2)], last_hm=2)
+        # Append interrotto a metà riga
+        with open('fatture_generate.jsonl', 'ab') as f:
+            f.write(b'{"po_number": "PO3", "numero_fat')
+
+        processor = app.HertzProcessor()
+        self.assertEqual([f['numero_fattura'] for f in processor.data['fatture_generate']], [1, 2])
+        lines = Path('fatture_generate.jsonl').read_bytes().splitlines()
+        self.assertEqual(len(lines), 2)
+        # I nuovi append restano leggibili
+        processor.append_fattura(fattura(3))
+        self.assertEqual(len(app.HertzProcessor().data['fatture_generate']), 3)
+
+    def test_invalid_middle_line_raises(self):
+        self.new_processor([fattura(1), fattura(2)], last_hm=2)
+        lines = Path('fatture_generate.jsonl').read_bytes().splitlines(keepends=True)
+        Path('fatture_generate.jsonl').write_bytes(lines[0] + b'{non valida\n' + lines[1])
+
+        with self.assertRaises(ValueError):
+            app.HertzProcessor()
+
+    def test_invoiced_documents_are_dropped(self):
+        invoiced = fattura(1)
+        processor = self.new_processor([invoiced], last_hm=1)
+        # Fattura registrata ma preventivo e PO non ancora tolti dal file principale
+        processor.data['preventivi'] = [
+            {'id': '1', 'pratica_hertz': invoiced['pratica_hertz']},
+            {'id': '2', 'pratica_hertz': 'P-APERTA'},
+        ]
+        processor.data['purchase_orders'] = [
+            {'id': '3', 'po_number': invoiced['po_number']},
+            {'id': '4', 'po_number': 'PO-APERTO'},
+        ]
+        processor.save_data()
+
+        data = app.HertzProcessor().data
+        self.assertEqual([p['pratica_hertz'] for p in data['preventivi']], ['P-APERTA'])
+        self.assertEqual([p['po_number'] for p in data['purchase_orders']], ['PO-APERTO'])
+        # Anche il file principale è stato riscritto
+        saved = json.loads(Path('hertz_data.json').read_bytes())
+        self.assertEqual([p['id'] for p in saved['preventivi'] + saved['purchase_orders']], ['2', '4'])
+
+
+class ReconcileNumberingTest(LoadDataTestCase):
+    def test_counters_follow_invoices_appended_after_last_save(self):
+        processor = self.new_processor([fattura(1), fattura(1, 'HG')], last_hm=1, last_hg=1)
+        # Interruzione durante genera-tutti: fatture nel JSONL, contatori non salvati
+        processor.append_fattura(fattura(2))
+        processor.append_fattura(fattura(3))
+        processor.append_fattura(fattura(2, 'HG'))
+
+        config = app.HertzProcessor().data['config']
+        self.assertEqual(config['last_number_hm'], 3)
+        self.assertEqual(config['last_number_hg'], 2)
+
+    def test_manual_numbering_survives_restart(self):
+        fatture = [fattura(n) for n in range(1, 40)] + [fattura(n, 'HG') for n in range(1, 16)]
+        processor = self.new_processor(fatture, last_hm=39, last_hg=15)
+        # Correzione da /update-numerazione
+        processor.data['config'].update(last_number_hm=30, last_number_hg=10)
+        processor.save_data()
+
+        config = app.HertzProcessor().data['config']
+        self.assertEqual(config['last_number_hm'], 30)
+        self.assertEqual(config['last_number_hg'], 10)
+
+    def test_deleting_invoices_keeps_later_ones_counted(self):
+        processor = self.new_processor([fattura(1), fattura(2)], last_hm=2)
+        processor.delete_fattura(fattura(1)['filename'])
+        processor.append_fattura(fattura(3))
+
+        self.assertEqual(app.HertzProcessor().data['config']['last_number_hm'], 3)
+
+    def test_new_year_in_log_resets_counters(self):
+        processor = self.new_processor([fattura(7, 'HG')], last_hm=12, last_hg=7)
+        processor.append_fattura(dict(fattura(1), data_generazione=f'{YEAR + 1}-01-02T09:00:00'))
+
+        config = app.HertzProcessor().data['config']
+        self.assertEqual(config['year'], YEAR + 1)
+        self.assertEqual(config['last_number_hm'], 1)
+        self.assertEqual(config['last_number_hg'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
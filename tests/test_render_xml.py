@@ -0,0 +1,68 @@
+"""L'XML Easyfatt generato deve restare identico a quello di riferimento
+
+Esecuzione: python -m unittest discover tests
+"""
+import os
+import re
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURE = Path(__file__).resolve().parent / 'fixtures' / 'fattura_easyfatt.xml'
+
+PREVENTIVO = {
+    'pratica_hertz': '123456',
+    'targa': 'GZ605WM',
+    'items': [
+        {'codice_ricambio': '51117379836', 'description': 'Paraurti anteriore',
+         'qty': 1, 'price': 250.0, 'discount': 10.0, 'total': 225.0},
+        {'description': 'Manodopera meccanica', 'qty': 1.5, 'price': 40.0, 'discount': 0, 'total': 60.0},
+        {'description': 'Smaltimento Rifiuti', 'qty': 1, 'price': 12.5, 'discount': 0, 'total': 12.5},
+    ],
+}
+
+PURCHASE_ORDER = {
+    'po_number': '7000123',
+    'targa': 'GZ605WM',
+    'vin': 'ZFA31200003456789',
+    'unit_number': '4455',
+    'model': 'FIAT PANDA 1.2',
+    'mileage': '45000',
+    'date': '2026-01-15',
+    'has_tyres': False,
+}
+
+app = None
+_cwd = None
+_tmp = None
+
+
+def setUpModule():
+    # app.py crea dati e cartelle nella directory corrente all'import
+    global app, _cwd, _tmp
+    _cwd = os.getcwd()
+    _tmp = tempfile.TemporaryDirectory()
+    os.chdir(_tmp.name)
+    sys.path.insert(0, str(ROOT))
+    import app as app_module
+    app = app_module
+
+
+def tearDownModule():
+    os.chdir(_cwd)
+    _tmp.cleanup()
+
+
+class RenderXmlTest(unittest.TestCase):
+    def test_matches_reference(self):
+        xml_bytes, total = app._render_xml(PREVENTIVO, PURCHASE_ORDER, 42, 'HM')
+        # La data del documento è quella di generazione
+        xml_bytes = re.sub(rb'<Date>[^<]*</Date>', b'<Date>DATA</Date>', xml_bytes)
+        self.assertEqual(xml_bytes, FIXTURE.read_bytes())
+        self.assertAlmostEqual(total, 362.95)
+
+
+if __name__ == '__main__':
+    unittest.main()